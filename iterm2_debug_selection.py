@@ -20,51 +20,126 @@ Installation:
 
 Output:
     - Writes JSON to ~/.config/iterm2-markdown/debug-output.json
+      (compact by default; pass --pretty or set PRETTY=1 for indented output)
+    - Set INCLUDE_FULL_LINE=1 to also include each line's full text
     - Also prints to iTerm2's script console
 """
 
 import asyncio
+import itertools
 import json
 import os
+import sys
 from pathlib import Path
 from datetime import datetime
 
 import iterm2
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Indent the JSON output for human reading. Compact output is considerably
+# smaller and faster to write, so it is the default. Enable with --pretty or
+# PRETTY=1.
+PRETTY = "--pretty" in sys.argv[1:] or os.environ.get("PRETTY") == "1"
+
+# Include each line's full text alongside the selected portion. Off by default
+# since it mostly repeats unselected content; set INCLUDE_FULL_LINE=1 to enable.
+INCLUDE_FULL_LINE = os.environ.get("INCLUDE_FULL_LINE") == "1"
+
+# Output location, resolved and created once at import rather than per run
+_OUTPUT_DIR = Path.home() / ".config" / "iterm2-markdown"
+_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+_OUTPUT_FILE = _OUTPUT_DIR / "debug-output.json"
+
+
+# Per-call conversion caches keyed on CellStyle identity. A line shares one
+# CellStyle object across each stretch of identically styled cells, so these
+# collapse one conversion per character into one per style object. (Colors
+# are not cached this way: CellStyle builds a new Color on every access.)
+# _cache_refs keeps the keyed objects alive so their ids cannot be recycled
+# while the caches are populated; clear_caches() drops everything.
+_style_cache = {}
+_style_key_cache = {}
+_cache_refs = []
+
+# Canonical instance of every style key seen, so equal keys are also
+# identical objects (see _interned_style_key).
+_interned_keys = {}
+
+
+def _cached(cache, convert, obj):
+    """Return convert(obj), memoized in cache by the identity of obj."""
+    key = id(obj)
+    try:
+        return cache[key]
+    except KeyError:
+        result = cache[key] = convert(obj)
+        _cache_refs.append(obj)
+        return result
+
+
+def clear_caches():
+    """Drop all memoized conversions and the references that pin them."""
+    _style_cache.clear()
+    _style_key_cache.clear()
+    _cache_refs.clear()
+    _interned_keys.clear()
+    _interned_keys[_DEFAULT_KEY] = _DEFAULT_KEY
+
 
 def color_to_dict(color):
-    """Convert an iTerm2 Color object to a serializable dict."""
-    if color is None:
-        return None
+    """
+    Convert an iTerm2 Color object to a serializable dict.
 
-    # Color can be various types - try to extract useful info
+    Returns None for no color or the terminal's default color.
+    """
+    # Read the color's value the same way the run keys do
     try:
-        # Check if it has RGB components
-        if hasattr(color, 'red') and hasattr(color, 'green') and hasattr(color, 'blue'):
-            return {
-                "type": "rgb",
-                "red": color.red,
-                "green": color.green,
-                "blue": color.blue,
-            }
-        # Check if it's an indexed color
-        if hasattr(color, 'color_index'):
-            return {
-                "type": "indexed",
-                "index": color.color_index,
-            }
-        # Fallback: stringify it
-        return {"type": "unknown", "value": str(color)}
+        key = _color_key(color)
     except Exception as e:
         return {"type": "error", "error": str(e)}
 
+    if key is None:
+        return None
+    kind = key[0]
+    if kind == "rgb":
+        return {
+            "type": "rgb",
+            "red": key[1],
+            "green": key[2],
+            "blue": key[3],
+        }
+    if kind == "s":
+        return {
+            "type": "indexed",
+            "index": key[1],
+        }
+    if kind == "a":
+        return {
+            "type": "alternate",
+            "value": key[1].name,
+        }
+    return {
+        "type": "placement",
+        "value": key[1],
+    }
+
 
 def style_to_dict(style):
-    """Convert an iTerm2 CellStyle object to a serializable dict."""
+    """
+    Convert an iTerm2 CellStyle object to a serializable dict.
+
+    fg_color and bg_color are only included when the cell overrides the
+    terminal's default colors.
+    """
     if style is None:
         return None
 
-    return {
+    result = {
         "bold": getattr(style, 'bold', None),
         "italic": getattr(style, 'italic', None),
         "underline": getattr(style, 'underline', None),
@@ -73,34 +148,235 @@ def style_to_dict(style):
         "inverse": getattr(style, 'inverse', None),
         "invisible": getattr(style, 'invisible', None),
         "blink": getattr(style, 'blink', None),
-        "fg_color": color_to_dict(getattr(style, 'fg_color', None)),
-        "bg_color": color_to_dict(getattr(style, 'bg_color', None)),
     }
+    fg = color_to_dict(getattr(style, 'fg_color', None))
+    if fg is not None:
+        result["fg_color"] = fg
+    bg = color_to_dict(getattr(style, 'bg_color', None))
+    if bg is not None:
+        result["bg_color"] = bg
+    return result
 
 
-def styles_equal(s1, s2):
-    """Check if two style dicts are equivalent."""
-    if s1 is None and s2 is None:
-        return True
-    if s1 is None or s2 is None:
-        return False
-    return s1 == s2
+# How iTerm2 reports a cell drawn in the default foreground/background color
+_DEFAULT_ALTERNATE = iterm2.screen.CellStyle.AlternateColor.DEFAULT
 
 
-async def get_selection_with_styles(session):
+def _color_key(color):
     """
-    Get the selected text from a session along with style information.
+    Convert an iTerm2 CellStyle.Color to a cheap hashable key.
 
-    Returns a list of line dictionaries, each containing:
+    CellStyle builds a fresh Color on every fg_color/bg_color access, so the
+    key is made from the color's value and never from the object itself.
+    """
+    if color is None:
+        return None
+    if color.is_standard:
+        return ("s", color.standard)
+    if color.is_alternate:
+        alternate = color.alternate
+        # The terminal's default text/background color is not an override
+        if alternate is _DEFAULT_ALTERNATE:
+            return None
+        return ("a", alternate)
+    if color.is_rgb:
+        rgb = color.rgb
+        return ("rgb", rgb.red, rgb.green, rgb.blue)
+    try:
+        return ("p", color.placement)
+    except ValueError:
+        return None
+
+
+def style_to_key(style):
+    """
+    Convert an iTerm2 CellStyle object to a hashable tuple.
+
+    The key holds the attribute flags and the color values, so cells with
+    the same style have equal keys and run boundaries can be found with a
+    tuple compare instead of building and comparing a dict per character.
+    """
+    if style is None:
+        return None
+
+    # CellStyle always carries these attributes, so read them directly and
+    # only fall back to the tolerant getattr path if one is ever missing.
+    try:
+        return (
+            style.bold,
+            style.italic,
+            style.underline,
+            style.strikethrough,
+            style.faint,
+            style.inverse,
+            style.invisible,
+            style.blink,
+            _color_key(style.fg_color),
+            _color_key(style.bg_color),
+        )
+    except AttributeError:
+        return (
+            getattr(style, 'bold', None),
+            getattr(style, 'italic', None),
+            getattr(style, 'underline', None),
+            getattr(style, 'strikethrough', None),
+            getattr(style, 'faint', None),
+            getattr(style, 'inverse', None),
+            getattr(style, 'invisible', None),
+            getattr(style, 'blink', None),
+            _color_key(getattr(style, 'fg_color', None)),
+            _color_key(getattr(style, 'bg_color', None)),
+        )
+
+
+# Names of the boolean attributes, in style_to_key order.
+_STYLE_FLAGS = (
+    "bold", "italic", "underline", "strikethrough",
+    "faint", "inverse", "invisible", "blink",
+)
+
+# Key of a cell with no attributes set and no color overrides. Cells without
+# a style (never written since the screen was cleared) also get this key.
+_DEFAULT_KEY = (False,) * len(_STYLE_FLAGS) + (None, None)
+_interned_keys[_DEFAULT_KEY] = _DEFAULT_KEY
+
+
+def _interned_style_key(style):
+    """
+    Return the canonical style_to_key(style) tuple.
+
+    Equal keys are always the same object, so comparing keys reduces to an
+    identity check: groupby's equality test short-circuits on identity, and
+    a default-styled cell's key is _DEFAULT_KEY itself.
+    """
+    if style is None:
+        return _DEFAULT_KEY
+    key = style_to_key(style)
+    return _interned_keys.setdefault(key, key)
+
+
+def build_lines_data(contents, start_coord, end_coord, active_styles):
+    """
+    Build the per-line selection data from fetched screen contents.
+
+    The names of any boolean style attributes seen in the emitted runs are
+    added to the active_styles set as lines are produced.
+
+    Yields one line dictionary at a time, each containing:
     - line_number: int
     - hard_eol: bool
-    - text: str (full line text)
+    - full_line_text: str (only if INCLUDE_FULL_LINE)
+    - selected_text: str
+    - selection_start / selection_end: int
     - runs: list of style runs
     """
+    first_line = start_coord.y
+    last_i = end_coord.y - first_line
+
+    # Bind globals used per character to locals once, up front
+    cached = _cached
+    key_cache = _style_key_cache
+    style_cache = _style_cache
+    to_key = _interned_style_key
+    to_dict = style_to_dict
+    default_key = _DEFAULT_KEY
+    add_styles = active_styles.update
+
+    for i, line in enumerate(contents):
+        line_num = first_line + i
+        line_text = line.string
+        line_len = len(line_text)
+
+        # Determine selection bounds for this line: the first line starts at
+        # the selection start, the last line stops at the selection end, and
+        # every other line is selected in full.
+        sel_start = start_coord.x if i == 0 else 0
+        sel_end = end_coord.x if i == last_i else line_len
+
+        # Extract only the selected portion
+        selected_text = line_text[sel_start:sel_end] if sel_end > sel_start else ""
+
+        sel_end_clamped = min(sel_end, line_len)
+
+        if sel_end_clamped <= sel_start:
+            # Nothing selected on this line
+            runs = []
+        elif sel_end_clamped - sel_start == 1:
+            # A single cell is a single run; no grouping needed
+            style = line.style_at(sel_start)
+            key = cached(key_cache, to_key, style)
+            if key is default_key:
+                style = None
+            else:
+                add_styles(name for name, val in zip(_STYLE_FLAGS, key) if val)
+                style = cached(style_cache, to_dict, style)
+            runs = [{
+                "text": line_text[sel_start],
+                "start": sel_start,
+                "end": sel_end_clamped,
+                "style": style,
+            }]
+        else:
+            # Build runs of consistent styling. Fetch every cell style once,
+            # reduce each to a hashable key, and group adjacent equal keys so
+            # style_to_dict only runs once per emitted run.
+            styles = list(map(line.style_at, range(sel_start, sel_end_clamped)))
+            keys = [cached(key_cache, to_key, s) for s in styles]
+
+            # Keys are interned, so identity is equality here
+            if all(k is default_key for k in keys):
+                # Plain unstyled text, the common case: one run with no style
+                # rather than a full style dict nobody will look at.
+                runs = [{
+                    "text": line_text[sel_start:sel_end_clamped],
+                    "start": sel_start,
+                    "end": sel_end_clamped,
+                    "style": None,
+                }]
+            else:
+                runs = []
+                append = runs.append
+                run_start = sel_start
+                for key, group in itertools.groupby(keys):
+                    run_end = run_start + sum(1 for _ in group)
+                    if key is default_key:
+                        style = None
+                    else:
+                        add_styles(name for name, val in zip(_STYLE_FLAGS, key) if val)
+                        style = cached(style_cache, to_dict, styles[run_start - sel_start])
+                    append({
+                        "text": line_text[run_start:run_end],
+                        "start": run_start,
+                        "end": run_end,
+                        "style": style,
+                    })
+                    run_start = run_end
+
+        line_data = {
+            "line_number": line_num,
+            "hard_eol": line.hard_eol,
+            "selected_text": selected_text,
+            "selection_start": sel_start,
+            "selection_end": sel_end,
+            "runs": runs,
+        }
+        if INCLUDE_FULL_LINE:
+            line_data["full_line_text"] = line_text
+        yield line_data
+
+
+async def get_selection_with_styles(session):
+    """
+    Get the selected text from a session along with style information.
+
+    Returns a (lines_data, active_styles, error) tuple. lines_data is a
+    generator of line dictionaries (see build_lines_data) and is meant to be
+    consumed once; active_styles is filled in as it is consumed.
+    """
     # Get the selection
     selection = await session.async_get_selection()
     if not selection or not selection.sub_selections:
-        return None, "No text selected"
+        return None, None, "No text selected"
 
     # Get selection coordinates
     sub = selection.sub_selections[0]
@@ -110,99 +386,103 @@ async def get_selection_with_styles(session):
     start_coord = sub.start
     end_coord = sub.end
 
-    # Get screen contents with style information
-    # We need to get the lines that contain the selection
-    line_info = await session.async_get_line_info()
-
     # Determine line range
     # Note: coordinates can be negative (scrollback) or positive (visible)
     first_line = start_coord.y
     last_line = end_coord.y
     num_lines = last_line - first_line + 1
 
-    # Fetch the contents
+    # Fetch the contents for the whole range in a single request
     try:
         contents = await session.async_get_contents(first_line, num_lines)
     except Exception as e:
-        return None, f"Failed to get contents: {e}"
+        return None, None, f"Failed to get contents: {e}"
 
-    lines_data = []
+    active_styles = set()
+    lines_data = build_lines_data(contents, start_coord, end_coord, active_styles)
+    return _iter_and_clear_caches(lines_data), active_styles, None
 
-    for i, line in enumerate(contents):
-        line_num = first_line + i
-        line_text = line.string
 
-        # Determine selection bounds for this line
-        if line_num == start_coord.y and line_num == end_coord.y:
-            # Selection is entirely within this line
-            sel_start = start_coord.x
-            sel_end = end_coord.x
-        elif line_num == start_coord.y:
-            # First line of multi-line selection
-            sel_start = start_coord.x
-            sel_end = len(line_text)
-        elif line_num == end_coord.y:
-            # Last line of multi-line selection
-            sel_start = 0
-            sel_end = end_coord.x
-        else:
-            # Middle line - entire line is selected
-            sel_start = 0
-            sel_end = len(line_text)
+def _iter_and_clear_caches(lines):
+    """Pass lines through, clearing the conversion caches once exhausted."""
+    try:
+        yield from lines
+    finally:
+        clear_caches()
+
+
+def dumps(obj):
+    """Serialize obj to UTF-8 JSON bytes, honoring PRETTY."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if PRETTY else 0)
+    # ensure_ascii=False skips escaping the non-ASCII text terminals often
+    # carry; the result is encoded to UTF-8 in one go instead.
+    if PRETTY:
+        return json.dumps(obj, indent=2, ensure_ascii=False).encode()
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def write_error_file(output_file, error):
+    """Write a failure result to output_file."""
+    with open(output_file, "wb") as f:
+        f.write(dumps({
+            "success": False,
+            "error": error,
+            "timestamp": datetime.now().isoformat(),
+        }))
 
-        # Extract only the selected portion
-        selected_text = line_text[sel_start:sel_end] if sel_end > sel_start else ""
 
-        # Build runs of consistent styling
-        runs = []
-        current_run_start = sel_start
-        current_style = None
-        current_text = ""
-
-        for x in range(sel_start, min(sel_end, len(line_text))):
-            char = line_text[x] if x < len(line_text) else ""
-            style = style_to_dict(line.style_at(x))
-
-            if current_style is None:
-                # First character
-                current_style = style
-                current_text = char
-            elif styles_equal(style, current_style):
-                # Same style, extend run
-                current_text += char
-            else:
-                # Style changed, save current run and start new one
-                if current_text:
-                    runs.append({
-                        "text": current_text,
-                        "start": current_run_start,
-                        "end": current_run_start + len(current_text),
-                        "style": current_style,
-                    })
-                current_run_start = x
-                current_style = style
-                current_text = char
-
-        # Don't forget the last run
-        if current_text:
-            runs.append({
-                "text": current_text,
-                "start": current_run_start,
-                "end": current_run_start + len(current_text),
-                "style": current_style,
-            })
-
-        lines_data.append({
-            "line_number": line_num,
-            "hard_eol": line.hard_eol,
-            "full_line_text": line_text,
-            "selected_text": selected_text,
-            "selection_start": sel_start,
-            "selection_end": sel_end,
-            "runs": runs,
-        })
+def write_output_file(output_file, session_id, lines_data):
+    """
+    Stream a successful result to output_file and return its simple text.
 
-    return lines_data, None
+    lines_data is consumed here, so when this runs in an executor the run
+    building in build_lines_data happens off the event loop as well.
+
+    Rather than building the whole result in memory, each line is touched
+    once: it is serialized as an element of the "lines" array and its
+    selected text is kept for simple_text, which is written after the array.
+    With PRETTY set the whole result is built and serialized in one go
+    instead, so it is indented consistently throughout.
+    """
+    if PRETTY:
+        lines = list(lines_data)
+        simple_text = "\n".join(line["selected_text"] for line in lines)
+        with open(output_file, "wb") as f:
+            f.write(dumps({
+                "success": True,
+                "timestamp": datetime.now().isoformat(),
+                "session_id": session_id,
+                "num_lines": len(lines),
+                "simple_text": simple_text,
+                "lines": lines,
+            }))
+        return len(lines), simple_text
+
+    simple_text_parts = []
+    add_text = simple_text_parts.append
+
+    with open(output_file, "wb") as f:
+        f.write(b'{"success":true,"timestamp":%s,"session_id":%s,"lines":[' % (
+            dumps(datetime.now().isoformat()),
+            dumps(session_id),
+        ))
+
+        separator = b""
+        for line in lines_data:
+            f.write(separator)
+            f.write(dumps(line))
+            add_text(line["selected_text"])
+            separator = b","
+
+        # Also create a simple text representation for quick viewing
+        simple_text = "\n".join(simple_text_parts)
+        f.write(b'],"num_lines":%d,"simple_text":%s}' % (
+            len(simple_text_parts),
+            dumps(simple_text),
+        ))
+
+    return len(simple_text_parts), simple_text
 
 
 async def main(connection):
@@ -217,61 +497,46 @@ async def main(connection):
         return
 
     # Get selection with styles
-    lines_data, error = await get_selection_with_styles(session)
+    lines_data, all_styles, error = await get_selection_with_styles(session)
 
-    if error:
-        result = {
-            "success": False,
-            "error": error,
-            "timestamp": datetime.now().isoformat(),
-        }
-    else:
-        # Also create a simple text representation for quick viewing
-        simple_text = "\n".join(
-            line["selected_text"] for line in lines_data
-        )
+    # Output to file
+    output_file = _OUTPUT_FILE
 
-        result = {
-            "success": True,
-            "timestamp": datetime.now().isoformat(),
-            "session_id": session.session_id,
-            "num_lines": len(lines_data),
-            "simple_text": simple_text,
-            "lines": lines_data,
-        }
+    # Building runs and serializing are synchronous CPU and file work, so
+    # do them in an executor to keep the iTerm2 connection responsive
+    loop = asyncio.get_running_loop()
 
-    # Output to file
-    output_dir = Path.home() / ".config" / "iterm2-markdown"
-    output_dir.mkdir(parents=True, exist_ok=True)
-    output_file = output_dir / "debug-output.json"
+    if error:
+        await loop.run_in_executor(None, write_error_file, output_file, error)
+
+        print(f"Debug output written to: {output_file}")
+        print(f"\nError: {error}")
+        return
 
-    with open(output_file, "w") as f:
-        json.dump(result, f, indent=2)
+    # The style summary is filled in as the lines are produced
+    num_lines, simple_text = await loop.run_in_executor(
+        None, write_output_file, output_file, session.session_id, lines_data,
+    )
 
     print(f"Debug output written to: {output_file}")
 
     # Also print a summary
-    if result["success"]:
-        print(f"\nSelected {result['num_lines']} lines")
-        print(f"\nSimple text:\n{result['simple_text'][:500]}...")
+    print(f"\nSelected {num_lines} lines")
+    print(f"\nSimple text:\n{simple_text[:500]}...")
 
-        # Print style summary
-        all_styles = set()
-        for line in lines_data:
-            for run in line["runs"]:
-                style = run["style"]
-                if style:
-                    for key, val in style.items():
-                        if val and key not in ("fg_color", "bg_color"):
-                            all_styles.add(key)
-
-        if all_styles:
-            print(f"\nStyles found: {', '.join(all_styles)}")
-        else:
-            print("\nNo text styles (bold/italic/etc) found")
+    if all_styles:
+        print(f"\nStyles found: {', '.join(all_styles)}")
     else:
-        print(f"\nError: {result['error']}")
+        print("\nNo text styles (bold/italic/etc) found")
+
 
+# Use uvloop's faster event loop for the iTerm2 connection when available
+try:
+    import uvloop
+except ImportError:
+    pass
+else:
+    uvloop.install()
 
 # iTerm2 script entry point
 iterm2.run_until_complete(main)